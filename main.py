@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
 import configparser
+import functools
 import logging
 import os
 import threading
 import time
+import types
+
+import numpy as np
 
 import lights
 from lights.device_unicornhat import UnicornHat
@@ -21,6 +25,8 @@ app_dir = os.path.split(os.path.abspath(__file__))[0]
 
 
 class DevicePosition:
+    __slots__ = ('name', 'x', 'y', 'w', 'h')
+
     def __init__(self, name, x, y, w, h):
         self.name = name
         self.x = x
@@ -44,67 +50,101 @@ class DevicePosition:
         return [new_x, new_y]
 
 
+# Parses a device file once per modification time; each section comes back as
+# a tuple of (option, value) pairs so the cached result can't be mutated
+@functools.lru_cache(maxsize=None)
+def _parse_device_config(df, mtime):
+    device_config = configparser.ConfigParser()
+    device_config.read(df)
+
+    return tuple((section, tuple(device_config[section].items())) for section in device_config.sections())
+
+
+# Returns a fresh {section: {option: value}} dict the caller is free to modify
+def load_device_config(df):
+    mtime = os.path.getmtime(df) if os.path.exists(df) else None
+
+    return {section: dict(options) for section, options in _parse_device_config(df, mtime)}
+
+
 class DeviceManager:
     def __init__(self, df):
-        self.devices = {}
-        self.devices_lock = threading.Lock()
+        # Devices are only registered from __init__, before any thread starts, so
+        # reads need no lock. Consumers get a read-only view of the dict.
+        self._devices = {}
+        self.devices = types.MappingProxyType(self._devices)
+        self._device_sizes = {}
+        self._device_list = ()
         self.layout = []
         self.layout_lock = threading.Lock()
+        self._layout_regions = ()
+        self._layout_size = (0, 0)
+        self.layout_version = 0
 
         # Build Devices
-        device_config = configparser.ConfigParser()
-        device_config.read(df)
-
-        for d in device_config.sections():
-            if 'type' in device_config[d]:
-                if device_config[d]['type'] == 'unicornhat':
-                    if 'rotation' in device_config[d]:
-                        rotation = int(device_config[d]['rotation'])
-                    else:
-                        rotation = 0
-
-                    if 'brightness' in device_config[d]:
-                        brightness = float(device_config[d]['brightness'])
-                    else:
-                        brightness = 1
-
-                    logging.debug(
-                        "attempting to init Unicorn Hat [{0} 8x8 bri:{1} rot:{2}]".format(d, brightness, rotation))
+        device_config = load_device_config(df)
+
+        for d, options in device_config.items():
+            if 'type' in options:
+                if options['type'] == 'unicornhat':
+                    rotation = int(options.get('rotation', 0))
+                    brightness = float(options.get('brightness', 1))
+
+                    logging.debug("attempting to init Unicorn Hat [%s 8x8 bri:%s rot:%s]", d, brightness, rotation)
                     self.add_device(UnicornHat(d, rotation, brightness))
-                elif device_config[d]['type'] == 'osc_grid':
-                    host = device_config[d]['host']
-                    if 'port' in device_config[d]:
-                        port = int(device_config[d]['port'])
-                    else:
-                        port = 5005
-                    width = int(device_config[d]['width'])
-                    height = int(device_config[d]['height'])
-
-                    logging.debug(
-                        "attempting to init OSC Grid [{0} {1}x{2} host:{3} port:{4}]".format(d, width, height, host,
-                                                                                             port))
+                elif options['type'] == 'osc_grid':
+                    host = options['host']
+                    port = int(options.get('port', 5005))
+                    width = int(options['width'])
+                    height = int(options['height'])
+
+                    logging.debug("attempting to init OSC Grid [%s %sx%s host:%s port:%s]", d, width, height, host,
+                                  port)
                     self.add_device(OSCGrid(d, width, height, host, port))
                 else:
-                    logging.warning(
-                        "device {0} has unsupported type: {1}. ignoring.".format(d, device_config[d]['type']))
+                    logging.warning("device %s has unsupported type: %s. ignoring.", d, options['type'])
             else:
-                logging.warning("device {0} doesn't have a type. ignoring.".format(d))
+                logging.warning("device %s doesn't have a type. ignoring.", d)
 
     def add_device(self, d):
-        with self.devices_lock:
-            logging.debug("adding device [{0}] to device manager".format(d.name, ))
-            self.devices[d.name] = d
+        logging.debug("adding device [%s] to device manager", d.name)
+        self._devices[d.name] = d
+        self._device_sizes[d.name] = d.get_size()
+        self._device_list = self._device_list + (d,)
         self.add_location(d.name, 0, 0)
 
     def add_location(self, name, x, y):
         with self.layout_lock:
-            logging.debug("adding device [{0}] to layout ".format(name, ))
+            logging.debug("adding device [%s] to layout ", name)
             w, h = self.get_device_size(name)
             self.layout.append(DevicePosition(name, x, y, w, h))
+            self._build_layout_cache()
+
+    # Rebuilds the read-only layout regions and size.
+    # Readers grab these references without taking layout_lock.
+    def _build_layout_cache(self):
+        max_x = 0
+        max_y = 0
+        for position in self.layout:
+            last_x, last_y = position.get_last_position()
+
+            if max_x < last_x + 1:
+                max_x = last_x + 1
+            if max_y < last_y + 1:
+                max_y = last_y + 1
+
+        self._layout_regions = tuple(
+            (self.get_device(position.name), position.x, position.y,
+             (slice(position.x, position.x + position.w), slice(position.y, position.y + position.h)))
+            for position in self.layout)
+        self._layout_size = (max_x, max_y)
+        self.layout_version += 1
+
+    def get_device(self, name):
+        return self.devices[name]
 
     def get_device_size(self, name):
-        with self.devices_lock:
-            return self.devices[name].get_size()
+        return self._device_sizes[name]
 
     def get_devices_at(self, x, y):
         device_list = []
@@ -116,23 +156,17 @@ class DeviceManager:
 
         return device_list
 
-    def get_layout_size(self):
-        max_x = 0
-        max_y = 0
-        for position in self.layout:
-            last_x, last_y = position.get_last_position()
+    # (device, x, y, region) per position, region being the slices that cut the
+    # device out of a full layout frame
+    def get_layout_regions(self):
+        return self._layout_regions
 
-            if max_x < last_x + 1:
-                max_x = last_x + 1
-            if max_y < last_y + 1:
-                max_y = last_y + 1
-
-        return [max_x, max_y]
+    def get_layout_size(self):
+        return self._layout_size
 
     def show_all(self):
-        with self.devices_lock:
-            for device in self.devices:
-                self.devices[device].show()
+        for device in self._device_list:
+            device.show()
 
 
 # Threadsafe Config
@@ -144,6 +178,7 @@ class RunningConfig:
         self.trigger_source = "timer"
         self.trigger_timer_length = 0.03
         self.trigger_lock = threading.Lock()
+        self.trigger_changed = threading.Event()
 
     def get_mode(self):
         with self.mode_lock:
@@ -163,75 +198,161 @@ class RunningConfig:
 
     def set_trigger_source(self, s):
         with self.trigger_lock:
-            self.mode = s
+            self.trigger_source = s
+        self.trigger_changed.set()
 
     def set_trigger_timer_length(self, l):
         with self.trigger_lock:
             self.trigger_timer_length = l
 
+    # Blocks until set_trigger_source is called
+    def wait_trigger_change(self):
+        self.trigger_changed.wait()
+        self.trigger_changed.clear()
+
 
 # Threads
 
 
+def trigger_timer(rc, bng):
+    time.sleep(rc.get_trigger_timer_length())
+    bng.set()
+
+
+# Trigger handlers by source, each fires bng at most once per call
+triggers = {
+    "timer": trigger_timer,
+}
+
+
 def thread_trigger(rc, bng):
     logging.info("starting Trigger")
 
     while True:
-        trigger_source = rc.get_trigger_source()
-        if trigger_source is "timer":
-            time.sleep(rc.get_trigger_timer_length())
-            bng.set()
+        trigger = triggers.get(rc.get_trigger_source())
+
+        # Sources without a handler here don't fire; sleep until the source changes
+        if trigger is None:
+            rc.wait_trigger_change()
+        else:
+            trigger(rc, bng)
 
 
 # Frame Maker
 # Builds a new frame and pushes into nextFrame buffer
-def thread_frame_maker(rc, bng, nf, dm, prg):
+def thread_frame_maker(rc, bng, nf, rdy, dm, prg):
     logging.info("starting FrameMaker")
 
+    mode = None
+    program = None
+
+    layout_version = dm.layout_version
+    size_x, size_y = dm.get_layout_size()
+
     while True:
         bng.wait()
-        size_x, size_y = dm.get_layout_size()
 
-        mode = rc.get_mode()
+        if dm.layout_version != layout_version:
+            layout_version = dm.layout_version
+            size_x, size_y = dm.get_layout_size()
+
+        # Only look up the program when the mode changes
+        current_mode = rc.get_mode()
+        if current_mode != mode:
+            mode = current_mode
+            program = prg.get(mode)
 
-        if mode is "cross":
-            nf.set(prg["cross"].get_next_frame(size_x, size_y))
+            if program is None:
+                logging.warning("mode %s has no program. ignoring.", mode)
+
+        if program is not None:
+            nf.set(program.get_next_frame(size_x, size_y))
+            rdy.set()
 
         bng.clear()
 
 
-# LightWrite
-# Compares new frame buffer to current buffer and updates lights
-def thread_light_write(cf, nf, dm):
-    logging.info("starting LightWrite")
+# Cuts each device's region out of the changed mask and returns
+# (device, x, y, r, g, b) updates in device local coordinates
+def compute_updates(frame, changed, regions):
+    updates = []
 
-    while True:
-        current_frame = cf.get()
-        next_frame = nf.get()
+    for device, offset_x, offset_y, region in regions:
+        for x, y in np.argwhere(changed[region]).tolist():
+            r, g, b = frame[offset_x + x, offset_y + y, :3].tolist()
+            updates.append((device, x, y, r, g, b))
 
-        if current_frame != next_frame:
-            size_x = len(next_frame)
-            size_y = len(next_frame[0])
+    return updates
 
-            for x in range(size_x):
-                for y in range(size_y):
-                    if current_frame[x][y] != next_frame[x][y]:
-                        r = next_frame[x][y][0]
-                        g = next_frame[x][y][1]
-                        b = next_frame[x][y][2]
 
-                        update_list = dm.get_devices_at(x, y)
+# Frames are stored as (x, y, 4) with a zero pad byte so each pixel can be
+# read as a single uint32 through packed()
+def new_frame_pool(size_x, size_y):
+    return [np.zeros((size_x, size_y, 4), dtype=np.uint8) for _ in range(2)]
 
-                        for device in update_list:
-                            offset_x = device.x
-                            offset_y = device.y
 
-                            dm.devices[device.name].set(r, g, b, x - offset_x, y - offset_y)
+def packed(frame):
+    return frame.view(np.uint32)[..., 0]
 
 
+# LightWrite
+# Waits for a new frame, compares it to current buffer and updates lights
+def thread_light_write(nf, rdy, dm):
+    logging.info("starting LightWrite")
+
+    # Two preallocated frames: front is what the lights show, back is refilled from nf
+    frames = new_frame_pool(*dm.get_layout_size())
+    front = 0
+    last_seen = None
+    stale_pad = False
+
+    while True:
+        rdy.wait()
+        rdy.clear()
+
+        # A frame object that was already handled needs no diff
+        frame = nf.get()
+        if frame is last_seen:
+            continue
+        last_seen = frame
+
+        # An empty layout has nothing to draw
+        if len(frame) == 0 or len(frame[0]) == 0:
+            continue
+
+        # Carry what the lights show over into the resized front frame so the
+        # diff still reflects the hardware state. Outside the old frame that
+        # state is unknown, so those pixels get a non-zero pad byte to force a push.
+        frame_size = (len(frame), len(frame[0]))
+        if frame_size != frames[front].shape[:2]:
+            shown = frames[front]
+            frames = new_frame_pool(*frame_size)
+            overlap_x = min(frame_size[0], shown.shape[0])
+            overlap_y = min(frame_size[1], shown.shape[1])
+            frames[front][..., 3] = 1
+            frames[front][:overlap_x, :overlap_y] = shown[:overlap_x, :overlap_y]
+            stale_pad = overlap_x < frame_size[0] or overlap_y < frame_size[1]
+
+        current_frame = frames[front]
+        next_frame = frames[front ^ 1]
+        # Programs may hand back fractional or out of range values (e.g. mid-fade);
+        # round and clip them, as the uint8 store would truncate or raise
+        next_frame[..., :3] = np.rint(np.clip(frame, 0, 255))
+
+        changed = packed(current_frame) != packed(next_frame)
+
+        if changed.any():
+            for device, x, y, r, g, b in compute_updates(next_frame, changed, dm.get_layout_regions()):
+                device.set(r, g, b, x, y)
+
             dm.show_all()
 
-            cf.set(next_frame)
+            front ^= 1
+
+            # The old front becomes the back; drop its pad markers before reuse
+            if stale_pad:
+                frames[front ^ 1][..., 3] = 0
+                stale_pad = False
 
 
 if __name__ == "__main__":
@@ -244,7 +365,6 @@ if __name__ == "__main__":
     # Frame Bufferd
     buff_init_x, buff_init_y = device_manager.get_layout_size()
 
-    current_frame_buffer = lights.FrameBuffer(buff_init_x, buff_init_y)
     next_frame_buffer = lights.FrameBuffer(buff_init_x, buff_init_y)
 
     # Programs
@@ -253,15 +373,16 @@ if __name__ == "__main__":
 
     # Events
     bang = threading.Event()
+    frame_ready = threading.Event()
 
     tlw = threading.Thread(name='LightWrite',
                            target=thread_light_write,
-                           args=(current_frame_buffer, next_frame_buffer, device_manager))
+                           args=(next_frame_buffer, frame_ready, device_manager))
     tlw.start()
 
     tfm = threading.Thread(name='FrameMaker',
                            target=thread_frame_maker,
-                           args=(running_config, bang, next_frame_buffer, device_manager, programs))
+                           args=(running_config, bang, next_frame_buffer, frame_ready, device_manager, programs))
     tfm.start()
 
     ttr = threading.Thread(name='Trigger',